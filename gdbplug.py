@@ -1,7 +1,13 @@
+import asyncio
+import bisect
+import functools
+import json
 import os
 import traceback
 import subprocess
+import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 try:
     import gdb as gdb
     RUNING_IN_GDB = True
@@ -9,39 +15,85 @@ except ImportError:
     import mockgdb as gdb
     RUNING_IN_GDB = False
 
+# 1. start with windows drive name E.g: 'C:' 'D:'
+# 2. start with uinx path name E.g: '%' '/home' '~/.config'
+_LOCAL_RE = re.compile(r'^[a-zA-Z]:|^[%~/]')
 
-class PlugInitConfig(dict):
+
+class PlugInitConfig:
     """Store init config, and infer plug config based on init config"""
+    __slots__ = ('home', 'autoload', 'uri_format', '_dir_cache')
 
     def __init__(self, home=None, autoload=None, uri_format=None):
-        self['home'] = self.first_not_none(
+        self.home = self.first_not_none(
             os.getenv('GDB_PLUG_HOME'),
             home,
             os.path.expanduser('~/.config/gdb/plug')
         )
 
-        self['autoload'] = self.first_not_none(
+        self.autoload = self.first_not_none(
             os.getenv('GDB_PLUG_AUTOLOAD'),
             autoload,
             True
         )
 
-        self['uri_format'] = self.first_not_none(
+        self.uri_format = self.first_not_none(
             uri_format,
             'https://git::@github.com/{}.git'
         )
 
+        self._dir_cache = {}  # (name, repo, home, uri_format) -> infer_directory_uri()
+
+    # Keep the old dict style access (config['home'], 'home' in config,
+    # config.get(...), keys/items) working
+    _KEYS = ('home', 'autoload', 'uri_format')
+
+    def __getitem__(self, key):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._KEYS
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._KEYS else default
+
+    def keys(self):
+        return list(self._KEYS)
+
+    def values(self):
+        return [getattr(self, key) for key in self._KEYS]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self._KEYS]
+
+    def __repr__(self):
+        return (f"{type(self).__name__}(home={self.home!r}, "
+                f"autoload={self.autoload!r}, uri_format={self.uri_format!r})")
+
     @staticmethod
     def is_local_plug(repo):
-        # 1. start with windows drive name E.g: 'C:' 'D:'
-        # 2. start with uinx path name E.g: '%' '/home' '~/.config'
-        return bool(re.match(r'^[a-zA-Z]:|^[%~/]', repo))
+        return _LOCAL_RE.match(repo) is not None
 
     @staticmethod
     def first_not_none(*args):
         return next((x for x in args if x is not None), None)
 
-    def infer_name(self, repo):
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def infer_name(repo):
         bn = repo.split('/')[-1]  # basename
         # remove tail .git
         bn = bn[:-4] if bn.endswith('.git') else bn
@@ -60,10 +112,10 @@ class PlugInitConfig(dict):
         else:
             if '/' not in repo:
                 raise ValueError(f"Invalid argument: {repo}")
-            uri = self["uri_format"].format(repo)
+            uri = self.uri_format.format(repo)
         return {
             'uri': uri,
-            'directory': os.path.join(self["home"], name)
+            'directory': os.path.join(self.home, name)
         }
 
     @staticmethod
@@ -73,19 +125,21 @@ class PlugInitConfig(dict):
         elif isinstance(value, int):
             return bool(value)
         elif isinstance(value, str):
-            value = value.split(',')
+            true_set = frozenset(("all", "true", "1", *groups))
+            false_set = frozenset(("none", "false", "0", *("-" + g for g in groups)))
             ret = False
-            for x in value:
-                if x.lower() in ["all", "true", "1"] + groups:
-                    ret = True
-                if x.lower() in ["none", "false", "0"] + ["-"+group for group in groups]:
+            # last token wins, a token in both sets counts as false
+            for x in value.lower().split(','):
+                if x in false_set:
                     ret = False
+                elif x in true_set:
+                    ret = True
             return ret
         else:
             return False
 
     def infer_kv(self, key, value):
-        return value if value is not None else self[key]
+        return value if value is not None else getattr(self, key)
 
     def infer_config(self, repo, name=None, autoload=None, groups=None):
         groups = groups or []
@@ -93,9 +147,13 @@ class PlugInitConfig(dict):
         config = {
             'name': name,
             'repo': repo,
-            'autoload': self.infer_bool_bygroup(autoload or self["autoload"], [name] + groups)
+            'autoload': self.infer_bool_bygroup(autoload or self.autoload, [name] + groups)
         }
-        config_segment = self.infer_directory_uri(name, repo)
+        # the result also depends on home and uri_format, which can be changed
+        key = (name, repo, self.home, self.uri_format)
+        if key not in self._dir_cache:
+            self._dir_cache[key] = self.infer_directory_uri(name, repo)
+        config_segment = self._dir_cache[key]
         config.update(config_segment)
         return config
 
@@ -107,114 +165,341 @@ class PlugManager:
         self.init = PlugInitConfig(**kargs)
 
         self.plug_infos = {}
-        os.makedirs(self.init["home"], exist_ok=True)
+        self._names_sorted = []  # kept sorted for prefix completion
+        self._autoload_names = []  # in registration order
+        self._installed_cache = None  # (timestamp, set of dir names)
+        os.makedirs(self.init.home, exist_ok=True)
+
+        # name -> {'directory', 'dir_mtime', 'init', 'mtime'} of the last
+        # loaded init file
+        self._index_path = os.path.join(self.init.home, '.index.json')
+        self._index_dirty = False
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        if not isinstance(self._index, dict):
+            self._index = {}
+
+    def _installed_set(self):
+        """Names of directories under home, cached for a short while"""
+        now = time.monotonic()
+        if self._installed_cache is None or now - self._installed_cache[0] > 1:
+            try:
+                with os.scandir(self.init.home) as it:
+                    installed = {e.name for e in it if e.is_dir()}
+            except OSError:
+                installed = set()
+            self._installed_cache = (now, installed)
+        return self._installed_cache[1]
+
+    def _is_installed(self, plugin):
+        """Check plugin directory, one scandir for all plugins under home"""
+        directory = plugin['directory']
+        if os.path.dirname(directory) == self.init.home:
+            return os.path.basename(directory) in self._installed_set()
+        return os.path.isdir(directory)
 
     def plug(self, repo, **kargs):
         """Register a plugin repository"""
         config = self.init.infer_config(repo, **kargs)
-        self.plug_infos[config['name']] = config
+        config['_installed'] = self._is_installed(config)
+        name = config['name']
+        # Init file names looked up by load(), in priority order
+        config['_init_candidates'] = (
+            f"{name}.py",
+            f"{name}.gdb",
+            "main.py",
+            "main.gdb",
+            ".gdbinit",
+            f"gdbinit-{name.lower()}.py",  # for example gdbinit-gep.py
+        )
+        known = name in self.plug_infos
+        if not known:
+            bisect.insort(self._names_sorted, name)
+        # A re-registered plugin keeps its place in the load order
+        self.plug_infos[name] = config
+        if name in self._autoload_names:
+            if not config['autoload']:
+                self._autoload_names.remove(name)
+        elif config['autoload']:
+            if known:
+                # autoload turned back on, put it back at its registration slot
+                self._autoload_names = [
+                    n for n, p in self.plug_infos.items() if p['autoload']]
+            else:
+                self._autoload_names.append(name)
         return self
 
+    def names_with_prefix(self, prefix):
+        """Return registered plugin names starting with prefix"""
+        names = self._names_sorted
+        i = bisect.bisect_left(names, prefix)
+        out = []
+        while i < len(names) and names[i].startswith(prefix):
+            out.append(names[i])
+            i += 1
+        return out
+
     def update(self, names=None):
         """Update specified plugins or all plugins"""
         names = names or list(self.plug_infos.keys())
         names = names.split(',') if isinstance(names, str) else names
-
+        # the same plugin twice would run two git children on one directory
+        names = list(dict.fromkeys(names))
+
+        # git is network bound, so run one child per plugin concurrently and
+        # print the buffered output in the original order afterwards.
+        # When only one git runs at a time, let it write to the terminal
+        # directly so that long clones show live progress.
+        try:
+            jobs = max(int(os.getenv('GDB_PLUG_JOBS', '8')), 1)
+        except ValueError:
+            jobs = 8
+        stream = jobs == 1 or len(names) == 1
+        results = asyncio.run(self._sync_all_async(names, jobs, stream))
+
+        outputs = dict(results)
         for name in names:
+            print(outputs[name])
+        self._save_index()
+
+    async def _sync_all_async(self, names, jobs, stream=False):
+        sem = asyncio.Semaphore(jobs)
+        return await asyncio.gather(
+            *[self._sync_one_async(name, sem, stream) for name in names])
+
+    async def _git(self, argv, capture=True):
+        """Run a git command, return (returncode, stdout, stderr)
+
+        Without capture the child writes to GDB's terminal directly.
+        """
+        pipe = asyncio.subprocess.PIPE if capture else None
+        proc = await asyncio.create_subprocess_exec(
+            'git', *argv,
+            stdout=pipe,
+            stderr=pipe
+        )
+        try:
+            out, err = await proc.communicate()
+        except asyncio.CancelledError:
+            # Do not leave orphaned git processes behind on ^C
+            proc.kill()
+            await proc.wait()
+            raise
+        return (
+            proc.returncode,
+            (out or b'').decode(errors='replace'),
+            (err or b'').decode(errors='replace')
+        )
+
+    async def _sync_one_async(self, name, sem, stream=False):
+        """Install or update a single plugin, return (name, output)
+
+        At most `sem` plugins sync at a time. The semaphore is held for all
+        git commands of the plugin, so streamed output of one plugin is never
+        interleaved with another's. When git output is streamed, a header is
+        printed so it can be told apart.
+        """
+        async with sem:
             if name not in self.plug_infos:
-                print(f"Plugin not registered: {name}")
-                continue
+                return name, f"Plugin not registered: {name}"
 
             plugin = self.plug_infos[name]
             repo_dir = plugin['directory']
             repo_uri = plugin['uri']
 
             if repo_uri is None:
-                print("Not a remote repo, do nothing...")
-                return
+                return name, f"Not a remote repo, do nothing for {name}..."
+
+            # Plugins are used at HEAD, so only fetch the tip unless asked not to
+            shallow = os.getenv('GDB_PLUG_FULL_CLONE') != '1'
+
+            if not self._is_installed(plugin):
+                if stream:
+                    print(f"Installing {name}...")
+                argv = ['clone']
+                if shallow:
+                    argv += ['--depth=1', '--filter=blob:none', '--single-branch']
+                rc, _, err = await self._git(argv + [repo_uri, repo_dir], not stream)
+                self._installed_cache = None
+                if rc != 0:
+                    return name, f"Failed to install {name}: {err}"
+                plugin['_installed'] = True
+                self._forget_index(name)
+                return name, f"Installed {name}"
+
+            if stream:
+                print(f"Updating {name}...")
 
-            if not os.path.exists(repo_dir):
-                print(f"Installing {name}...")
-                result = subprocess.run(
-                    ['git', 'clone', repo_uri, repo_dir],
-                    # capture_output=True,
-                    # text=True
-                )
-                if result.returncode != 0:
-                    print(f"Failed to install {name}: {result.stderr}")
-                    continue
-                print(f"Installed {name}")
+            # A tiny ls-remote avoids pack negotiation when nothing changed, any
+            # failure here just falls through to a regular update.
+            rc, out, _ = await self._git(['-C', repo_dir, 'rev-parse', 'HEAD'])
+            local = out.strip() if rc == 0 else None
+            if local:
+                rc, out, _ = await self._git(['ls-remote', repo_uri, 'HEAD'])
+                remote = out.split() if rc == 0 else None
+                if remote and remote[0] == local:
+                    return name, f"{name} up to date"
+
+            if shallow:
+                rc, _, err = await self._git(
+                    ['-C', repo_dir, 'fetch', '--depth=1', 'origin'], not stream)
+                if rc == 0:
+                    rc, _, err = await self._git(
+                        ['-C', repo_dir, 'reset', '--hard', 'FETCH_HEAD'], not stream)
             else:
-                print(f"Updating {name}...")
-                result = subprocess.run(
-                    ['git', '-C', repo_dir, 'pull'],
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode != 0:
-                    print(f"Failed to update {name}: {result.stderr}")
-                    continue
-                print(f"Updated {name}")
+                rc, _, err = await self._git(['-C', repo_dir, 'pull'], not stream)
+            if rc != 0:
+                return name, f"Failed to update {name}: {err}"
+            self._forget_index(name)
+            return name, f"Updated {name}"
 
     def end(self):
         """Load specified plugins or all autoload plugins"""
         # Load all autoload plugins, or define in GDB_PLUG_AUTOLOAD
-        names_to_load = [
-            name
-            for name, plugin in self.plug_infos.items()
-            if
-            plugin.get('autoload')
-        ]
-        print(names_to_load)
-
-        for name in names_to_load:
-            self.load(name)
+        # Finding init files is plain file system work and can overlap, but
+        # GDB's API is not thread safe so sourcing stays on this thread.
+        names = self._autoload_names
+        if len(names) < 2:
+            results = [self._resolve_init_file(name) for name in names]
+        else:
+            with ThreadPoolExecutor(max_workers=4) as ex:
+                results = list(ex.map(self._resolve_init_file, names))
+
+        for result in results:
+            self._load_resolved(*result)
+        self._save_index()
+
+    def _save_index(self):
+        """Write the init file index back to disk if it changed"""
+        if not self._index_dirty:
+            return
+        try:
+            with open(self._index_path, 'w') as f:
+                json.dump(self._index, f)
+            self._index_dirty = False
+        except OSError as e:
+            print(f"Failed to write {self._index_path}: {str(e)}")
+
+    def _forget_index(self, name):
+        if self._index.pop(name, None) is not None:
+            self._index_dirty = True
+
+    def _source(self, name, init_file):
+        """Source an init file into GDB, return True on success"""
+        try:
+            gdb.execute(f"source {init_file}")
+            print(f"Loaded plugin: {name} from {init_file}")
+            return True
+        except Exception as e:
+            print(f"Failed to load {init_file}: {str(e)}")
+            traceback.print_exc()
+            return False
 
     def load(self, name):
         """Load a plugin by name"""
+        loaded = self._load_resolved(*self._resolve_init_file(name))
+        self._save_index()
+        return loaded
+
+    def _resolve_init_file(self, name):
+        """Find the init files of a plugin without touching GDB
 
+        Safe to call off the main thread. Return (name, init_files, error),
+        init_files being the existing candidates in load priority order.
+        """
         plugin = self.plug_infos.get(name)
         if not plugin:
-            print(f"Plugin not registered: {name}")
-            return False
+            return name, [], f"Plugin not registered: {name}"
 
         plugin_dir = plugin['directory']
-        if not os.path.exists(plugin_dir):
-            print(f"Plugin not installed: {name}. Run 'Plug update' to install.")
-            return False
 
-        # Look for initialization files
+        # Init file known from a previous session and unchanged since then.
+        # The directory mtime changes when files are added or removed, which
+        # could make a higher priority candidate appear.
+        entry = self._index.get(name)
+        if entry is not None:
+            try:
+                fresh = (entry.get('directory') == plugin_dir and
+                         os.stat(plugin_dir).st_mtime == entry['dir_mtime'] and
+                         os.stat(entry['init']).st_mtime == entry['mtime'])
+            except (OSError, KeyError, TypeError, AttributeError):
+                # missing file or a malformed entry, probe the directory
+                fresh = False
+            if fresh:
+                plugin['_installed'] = True
+                return name, [entry['init']], None
+            self._forget_index(name)
+
+        not_installed = f"Plugin not installed: {name}. Run 'Plug update' to install."
+
+        # Trust the state recorded by plug()/update() before hitting the disk
+        if not plugin.get('_installed') and not self._is_installed(plugin):
+            return name, [], not_installed
+        plugin['_installed'] = True
+
+        # Look for initialization files, one listdir instead of a stat each
+        try:
+            present = set(os.listdir(plugin_dir))
+        except OSError:
+            # directory removed since the flag was recorded
+            plugin['_installed'] = False
+            return name, [], not_installed
         init_files = [
-            os.path.join(plugin_dir, f"{name}.py"),
-            os.path.join(plugin_dir, f"{name}.gdb"),
-            os.path.join(plugin_dir, "main.py"),
-            os.path.join(plugin_dir, "main.gdb"),
-            os.path.join(plugin_dir, ".gdbinit"),
-            os.path.join(plugin_dir, f"gdbinit-{name.lower()}.py"),  # for example gdbinit-gep.py # noqa: E501
+            os.path.join(plugin_dir, candidate)
+            for candidate in plugin['_init_candidates']
+            if candidate in present
         ]
-
-        loaded = False
-        for init_file in init_files:
-            if os.path.exists(init_file):
-                try:
-                    gdb.execute(f"source {init_file}")
-                    print(f"Loaded plugin: {name} from {init_file}")
-                    loaded = True
-                    break
-                except Exception as e:
-                    print(f"Failed to load {init_file}: {str(e)}")
-                    traceback.print_exc()
-
-        if not loaded:
-            print(f"No valid initialization file found for plugin: {name}")
-            return False
-
-        return True
+        return name, init_files, None
+
+    def _load_resolved(self, name, init_files, error):
+        """Source the first working init file, must run on GDB's thread"""
+        tried = []
+        while error is None:
+            for init_file in init_files:
+                if init_file in tried:
+                    continue
+                tried.append(init_file)
+                if self._source(name, init_file):
+                    # a fresh index hit needs no rewrite of the index file
+                    entry = self._index.get(name)
+                    if not isinstance(entry, dict) or entry.get('init') != init_file:
+                        self._record_index(name, init_file)
+                    return True
+
+            if name not in self._index:
+                print(f"No valid initialization file found for plugin: {name}")
+                return False
+            # The indexed init file failed, drop it and probe the directory
+            self._forget_index(name)
+            _, init_files, error = self._resolve_init_file(name)
+
+        print(error)
+        return False
+
+    def _record_index(self, name, init_file):
+        plugin_dir = self.plug_infos[name]['directory']
+        try:
+            self._index[name] = {
+                'directory': plugin_dir,
+                'dir_mtime': os.stat(plugin_dir).st_mtime,
+                'init': init_file,
+                'mtime': os.stat(init_file).st_mtime
+            }
+            self._index_dirty = True
+        except OSError:
+            pass
 
     def list(self, name=None):
         """Return information about registered plugins"""
         name_to_list = name or self.plug_infos.keys()
-        return [plug for name, plug in self.plug_infos.items() if name in name_to_list]
+        # '_' prefixed keys are internal state, not plugin information
+        return [
+            {k: v for k, v in plug.items() if not k.startswith('_')}
+            for name, plug in self.plug_infos.items() if name in name_to_list
+        ]
 
 
 class Plug:
@@ -265,6 +550,7 @@ if RUNING_IN_GDB is True:
     import pprint
     class PlugCommand(gdb.Command):
         """GDB command interface for plugin management"""
+        SUBCOMMANDS = ('update', 'list', 'load')
 
         def __init__(self):
             super(PlugCommand, self).__init__(
@@ -308,11 +594,10 @@ if RUNING_IN_GDB is True:
             # extra = 1 if word is None else 0
             pword = word or ''
 
-            subcmd = ['update', 'list', 'load']
-            if parts[0] in subcmd:
-                return [plug['name'] for plug in Plug.list() if plug['name'].startswith(pword)]
+            if parts and parts[0] in self.SUBCOMMANDS:
+                return Plug()._manager.names_with_prefix(pword)
             else:
-                return [cmd for cmd in ['update', 'list', 'load'] if cmd.startswith(pword)]
+                return [cmd for cmd in self.SUBCOMMANDS if cmd.startswith(pword)]
 
 
 if __name__ == '__main__':